@@ -12,29 +12,109 @@ Code Inputs:
 Code Output:
     A png file containing a graph with stock values over time
 '''
-import copy
 import csv
 import datetime
+import functools
 import json
 import os
-import sqlite3
+import numpy as np
+import matplotlib
+# Output is a static PNG, so use the non-GUI Agg backend
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import traceback
 import tkinter as tk
 import tkinter.filedialog
 
+# ijson streams large JSON files row by row, orjson parses smaller ones much
+# faster. Both are optional, fall back to json if unavailable
+try:
+    import ijson
+except ImportError:
+    ijson = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Errors raised for malformed JSON by whichever parser is in use
+JSON_ERRORS = (ValueError, ijson.JSONError) if ijson is not None else (ValueError,)
+
+# JSON files larger than this (in bytes) are streamed with ijson when available
+STREAM_THRESHOLD = 256 * 1024 * 1024
+# Series longer than this are downsampled before plotting
+DOWNSAMPLE_THRESHOLD = 5000
+# Number of points kept for a downsampled series
+DOWNSAMPLE_POINTS = 2000
+# Month abbreviations used in the stock information dates
+_MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+           'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
 # ==============================================================================
 # Define Classes and Functions
 # ==============================================================================
 
 
+@functools.lru_cache(maxsize=None)
+def _parse_date(date):
+    '''Parse a "%d-%b-%y" date string, cached since dates repeat across stocks'''
+    # Split manually rather than use strptime, which goes through locale handling
+    if not isinstance(date, str):
+        raise TypeError(f"date must be str, not {type(date).__name__}")
+    day, month, year = date.split('-')
+    # Reject anything strptime would have, %b is case-insensitive
+    month_num = _MONTHS.get(month.title())
+    if (month_num is None or not day.isdigit() or not 1 <= len(day) <= 2
+            or not year.isdigit() or len(year) != 2):
+        raise ValueError(f"time data '{date}' does not match format '%d-%b-%y'")
+    # Match strptime's %y handling, 69-99 map to the 1900s
+    year = int(year)
+    year += 2000 if year < 69 else 1900
+    return datetime.datetime(year, month_num, int(day))
+
+
+def lttb_downsample(x, y, n_out):
+    '''Downsample a series to n_out points using Largest-Triangle-Three-Buckets,
+       which keeps the visual shape of the line'''
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+
+    # Work on numeric x values so datetime64 axes can be used in the area math
+    x_num = x.astype('int64').astype(float) if np.issubdtype(x.dtype, np.datetime64) \
+        else x.astype(float)
+
+    # First and last points are always kept, the rest are split into buckets
+    every = (n - 2) / (n_out - 2)
+    keep = [0]
+    a = 0
+    for i in range(n_out - 2):
+        # Average point of the next bucket
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x_num[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        # Keep the point in this bucket forming the largest triangle with the
+        # previously kept point and the next bucket average
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        area = np.abs((x_num[a] - avg_x) * (y[start:end] - y[a]) -
+                      (x_num[a] - x_num[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        keep.append(a)
+    keep.append(n - 1)
+
+    return x[keep], y[keep]
+
+
 class Stock_Timestamp():
     '''Class to hold stock timestamp information'''
 
     def __init__(self, symbol, date, close_price):
         self.symbol = symbol
-        self.date = datetime.datetime.strptime(date, "%d-%b-%y")
+        self.date = _parse_date(date)
         self.close_price = float(close_price)
 
 
@@ -53,9 +133,10 @@ class Investor():
     def __init__(self, name):
         self.name = name
         self.stocks = {}
-        self.stock_timestamps = {}
+        self.series = {}
         self.stock_volumes = {}
         self.symbol_dict = {}
+        self.symbol_set = frozenset()
 
     def add_stock(self, stock):
         '''Add new stock to stocks dictionary'''
@@ -70,47 +151,47 @@ class Investor():
         symbol_set = set(self.stocks.keys())
         for i in symbol_set:
             self.symbol_dict[i] = None
+        # Frozen copy of the owned symbols for fast membership tests
+        self.symbol_set = frozenset(self.symbol_dict)
+        # Init a pair of (dates, close prices) lists for each stock
+        self.series = {symbol: ([], []) for symbol in self.symbol_dict}
 
     def calculate_value(self, symbol, close):
-        '''Calculate the value of a stock (closing price * number of shares)'''
+        '''Calculate the value of a stock (closing price * number of shares),
+           close may be a single price or a sequence of prices'''
         num_shares = self.stock_volumes[symbol]
-        return num_shares * close
+        # Multiply every price by the share count in a single NumPy operation
+        return np.asarray(close, dtype=float) * num_shares
 
     def add_stock_timestamp(self, timestamp):
         '''Add a stock timestamp to the investor portfolio'''
+        # Called once per row, so look the symbol up only once
+        symbol = timestamp.symbol
         # Only process data that the investor owns
-        if timestamp.symbol in self.symbol_dict:
-            # Calculate the value of the stock on this date
-            value = self.calculate_value(
-                timestamp.symbol, timestamp.close_price)
-
-            # If a dictionary entry for this date does not exist, create it
-            if timestamp.date not in self.stock_timestamps:
-                # Deepcopy the default stock dictionary, prepopulated with None values
-                self.stock_timestamps[timestamp.date] = copy.deepcopy(
-                    self.symbol_dict)
-
-            # Populate the value of the stock on this date
-            self.stock_timestamps[timestamp.date][timestamp.symbol] = value
+        if symbol in self.symbol_set:
+            # Record the closing price, values are calculated in bulk when graphing
+            dates, closes = self.series[symbol]
+            dates.append(timestamp.date)
+            closes.append(timestamp.close_price)
 
     def prep_for_graph(self):
         '''Function to structure the data for input into matplotlib'''
-        # Sort dates to ensure proper order
-        sorted_dates = sorted(self.stock_timestamps)
-
-        # Create a dictionary where the values are lists, with an entry for each stock
-        # and an entry for dates
+        # Create a dictionary with a (dates, values) pair of arrays for each stock
         graph_dict = {}
-        graph_dict['dates'] = []
-        for key in self.symbol_dict.keys():
-            # Init list for each stock
-            graph_dict[key] = []
-
-        for date in sorted_dates:
-            graph_dict['dates'].append(date)
-            # Iterate through each stock value on this date and populate the proper lists
-            for key, value in self.stock_timestamps[date].items():
-                graph_dict[key].append(value)
+        for symbol, (dates, closes) in self.series.items():
+            # Naive datetimes convert to datetime64 in one vectorized pass, which
+            # matplotlib handles far faster than a list of datetime objects
+            dates = np.array(dates, dtype='datetime64[s]')
+            # Sort dates to ensure proper order, stable so duplicates keep file order
+            order = np.argsort(dates, kind='stable')
+            dates = dates[order]
+            # A repeated date keeps only its last entry, so later rows win
+            last = np.ones(len(dates), dtype=bool)
+            last[:-1] = dates[1:] != dates[:-1]
+            # Calculate the value of the stock on every date straight from the
+            # closes list, then apply the same order
+            values = self.calculate_value(symbol, closes)[order][last]
+            graph_dict[symbol] = (dates[last], values)
 
         return graph_dict
 
@@ -158,10 +239,103 @@ class FileControl():
     def get_output_path(self):
         return self.output_path
 
-# ==============================================================================
-# Main
-# ==============================================================================
-try:
+
+def load_portfolio(path):
+    '''Create an Investor from a portfolio CSV, returns None on failure'''
+    # Create Investor object
+    investor = Investor('Bob Smith')
+
+    # Read in CSV
+    try:
+        with open(path, mode='r') as csv_file:
+            stock_csv = csv.reader(csv_file)
+            # Locate the needed columns once from the header row
+            headers = next(stock_csv, [])
+            symbol_idx = headers.index('SYMBOL')
+            shares_idx = headers.index('NO_SHARES')
+            for stock in stock_csv:
+                # Skip blank lines, as DictReader did
+                if not stock:
+                    continue
+                # Instantiate a Stock object for each row in the CSV
+                try:
+                    stock_obj = Stock(stock[symbol_idx], stock[shares_idx])
+                except (ValueError, IndexError):
+                    print ('Error creating Stock object')
+                    continue
+
+                # Add the stock object to the investor object
+                investor.add_stock(stock_obj)
+    except (OSError, ValueError, csv.Error):
+        print('Error reading stock portfolio CSV')
+        traceback.print_exc()
+        return None
+
+    # Set stock metadata (unique names and share numbers)
+    investor.set_stock_metadata()
+    return investor
+
+
+def load_stock_json(path, investor):
+    '''Add stock information from a JSON file to the investor, returns
+       False on failure'''
+    # Open stock date json file
+    try:
+        with open(path, mode='rb') as f:
+            if ijson is not None and os.path.getsize(path) > STREAM_THRESHOLD:
+                # Stream one dict at a time instead of loading the whole file,
+                # note ijson returns Decimal rather than float numbers
+                data = ijson.items(f, 'item')
+            elif orjson is not None:
+                data = orjson.loads(f.read())
+            else:
+                data = json.load(f)
+
+            # Add each dict to investor as a Stock_Timestamp object
+            for row in data:
+                # Skip stocks the investor does not own before building any objects
+                if row['Symbol'] not in investor.symbol_set:
+                    continue
+                investor.add_stock_timestamp(
+                    Stock_Timestamp(row['Symbol'], row['Date'], row['Close']))
+    except (OSError, KeyError, TypeError) + JSON_ERRORS:
+        print('Error reading stock information JSON')
+        traceback.print_exc()
+        return False
+
+    return True
+
+
+def render_plot(investor, path):
+    '''Graph the value of each stock over time and save it as a PNG'''
+    # Format the data for ingest into matplotlib
+    data = investor.prep_for_graph()
+
+    fig, ax = plt.subplots()
+
+    # Iterate each stock series and create a plot line
+    for key, (x, value) in data.items():
+        # Thin out long series, extra points are not visible in the PNG
+        if len(x) > DOWNSAMPLE_THRESHOLD:
+            x, value = lttb_downsample(x, value, DOWNSAMPLE_POINTS)
+        ax.plot(x, value, label=key)
+
+    # Format X axis dates
+    fig.autofmt_xdate()
+    # Add legend
+    ax.legend()
+    # Save plot to disk as PNG
+    try:
+        fig.savefig(path)
+    except (OSError, ValueError):
+        print('Error saving graph')
+        traceback.print_exc()
+    finally:
+        plt.close(fig)
+
+
+def main():
+    '''Prompt for file paths, then graph the portfolio value over time'''
     # Init FileControl object to store paths
     file_control = FileControl()
 
@@ -190,79 +364,22 @@ try:
     # Keeps tkinter window open until exit_button is clicked
     window.mainloop()
 
-    # Warning that not all of the paths were entered in tkinter, imminent failure.
-    # Will allow to pass for traceback
+    # Not all of the paths were entered in tkinter, nothing to graph
     if not file_control.paths_exist():
         print ('File paths not populated correctly. Application will close')
+        return
 
-    # Create SQLite DB
-    conn = sqlite3.connect(':memory:')
+    investor = load_portfolio(file_control.get_portfolio_path())
+    if investor is None:
+        return
 
-    cur = conn.cursor()
-    # Create table for stock date information
-    cur.execute('CREATE TABLE stock_dates (symbol TEXT, date TEXT, open TEXT, high TEXT, ' +
-                'low TEXT, close REAL, volume REAL)')
-    print('Table Created')
+    if not load_stock_json(file_control.get_information_path(), investor):
+        return
 
-    # Create Investor object
-    investor = Investor('Bob Smith')
-
-    # Read in CSV
-    with open(file_control.get_portfolio_path(), mode='r') as csv_file:
-        stock_csv = csv.DictReader(csv_file)
-        for stock in stock_csv:
-            # Instantiate a Stock object for each row in the CSV
-            try:
-                stock_obj = Stock(stock['SYMBOL'], stock['NO_SHARES'])
-            except:
-                print ('Error creating Stock object')
-
-            # Add the stock object to the investor object
-            investor.add_stock(stock_obj)
-
-    # Set stock metadata (unique names and share numbers)
-    investor.set_stock_metadata()
+    render_plot(investor, file_control.get_output_path())
 
-    # Open stock date json file
-    with open(file_control.get_information_path()) as f:
-        data = json.load(f)
-
-    # Iterate dicts in file
-    for row in data:
-        symbol = row['Symbol']
-        date = row['Date']
-        open_price = row['Open']
-        high_price = row['High']
-        low_price = row['Low']
-        close = row['Close']
-        volume = row['Volume']
-
-        # Write each row to the database
-        cur.execute(f"INSERT INTO stock_dates VALUES ('{symbol}', '{date}', '{open_price}', " +
-                    f"'{high_price}', '{low_price}', {close}, {volume})")
-        conn.commit()
-
-        # Add each dict to investor as a Stock_Timestamp object
-        investor.add_stock_timestamp(Stock_Timestamp(symbol, date, close))
-
-    # Format the data for ingest into matplotlib
-    data = investor.prep_for_graph()
-
-    # Define X axis as dates and remove from dict
-    x = data['dates']
-    data.pop('dates')
-
-    # Iterate each stock list and create a plot line
-    for key, value in data.items():
-        plt.plot(x, value, label=key)
-
-    # Format X axis dates
-    plt.gcf().autofmt_xdate()
-    # Add legend
-    plt.legend()
-    # Save plot to disk as PNG
-    plt.savefig(file_control.get_output_path())
-
-except:
-    print('An error occured')
-    traceback.print_exc()
+# ==============================================================================
+# Main
+# ==============================================================================
+if __name__ == '__main__':
+    main()